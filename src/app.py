@@ -9,21 +9,108 @@ import numpy as np
 import os
 from werkzeug.utils import secure_filename
 import json
+import fcntl
+import tempfile
+from flask import Request
+from werkzeug.serving import is_running_from_reloader
 from displayer import Displayer
 from file_processor import process_file
+from library_atlas import LibraryAtlas
 import threading
 
 # pixels = neopixel.NeoPixel(board.D18, 1024, brightness=.06, auto_write=False)
-displayObject = Displayer(file_list=[], duration_of_files_seconds=10, on=False, brightness=20)
-display_thread = threading.Thread(target=displayObject.run)
-display_thread.start()
-
-app = Flask(__name__,template_folder="templates", static_folder='static')
+# the display engine is created by start_display() and not at import time so that importing this module
+# (e.g. from the debug reloader or from serve.py) never drives the LED strip on its own
+displayObject = None
+display_thread = None
+# held for the lifetime of the process, only one process per host may own the Adafruit_NeoPixel strip
+# a fixed path rather than the temp dir, which depends on TMPDIR and is private per service under systemd PrivateTmp=
+DISPLAY_LOCK_DIR = '/run/lock' if os.path.isdir('/run/lock') else '/var/lock'
+DISPLAY_LOCK_PATH = os.path.join(DISPLAY_LOCK_DIR, 'lightframe-display.lock')
+display_lock_file = None
 
 UPLOAD_FOLDER = os.path.join('static', 'uploads')
+ATLAS_FOLDER = os.path.join('static', 'atlas')
 # # Define allowed files
 ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif', 'mp4'])
+UPLOAD_TEMP_PREFIX = '.upload-'
+
+class UploadRequest(Request):
+    '''Request that streams uploaded files straight into a temporary file in UPLOAD_FOLDER.
+
+    The default request keeps small uploads in memory and copies large ones between temp files,
+    writing to the upload folder lets uploadFile() move the finished file into place with os.replace.
+    Every temporary file is recorded in upload_temp_paths, remove_upload_temp_files() deletes the ones
+    that were not moved into place once the request ends.
+    '''
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        stream = tempfile.NamedTemporaryFile('wb+', dir=UPLOAD_FOLDER, prefix=UPLOAD_TEMP_PREFIX, delete=False)
+        if not hasattr(self, 'upload_temp_paths'):
+            self.upload_temp_paths = []
+        self.upload_temp_paths.append(stream.name)
+        return stream
+
+def remove_stale_upload_temp_files():
+    '''Removes temporary upload files left in UPLOAD_FOLDER by a previous process that did not shut down cleanly.
+
+    ONLY CALL THIS WHILE HOLDING THE DISPLAY LOCK, otherwise a second instance would delete the uploads
+    the running instance is still receiving.
+    '''
+    for name in os.listdir(UPLOAD_FOLDER):
+        if name.startswith(UPLOAD_TEMP_PREFIX):
+            try:
+                os.remove(os.path.join(UPLOAD_FOLDER, name))
+            except OSError:
+                pass
+
+app = Flask(__name__,template_folder="templates", static_folder='static')
+app.request_class = UploadRequest
+
+@app.teardown_request
+def remove_upload_temp_files(exception):
+    '''Deletes the temporary files of this request that were not moved into place.
+
+    This covers uploads that were rejected, that failed in process_file, that were sent under another field name,
+    or whose multipart body was truncated before the parser handed the file to the route.
+    '''
+    for path in getattr(request, 'upload_temp_paths', []):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
+# files in static/ (including uploads) are sent with Cache-Control max-age and an ETag so browsers
+# only revalidate them once an hour instead of downloading them on every page load
+app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 3600
+
+# sprite sheet of first-frame thumbnails for everything in UPLOAD_FOLDER, see /library
+library_atlas = LibraryAtlas(UPLOAD_FOLDER, ATLAS_FOLDER)
+
+def start_display():
+    '''Creates the display engine and starts its thread.
+
+    Takes an exclusive lock on DISPLAY_LOCK_PATH first so that exactly one display engine runs per host.
+    Will raise RuntimeError if another process already owns the display.
+    '''
+    global displayObject, display_thread, display_lock_file
+    if displayObject is not None:
+        return displayObject
+
+    lock_file = open(DISPLAY_LOCK_PATH, 'w')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        raise RuntimeError(f'Another LightFrame process already owns the display (lock "{DISPLAY_LOCK_PATH}" is held).')
+    display_lock_file = lock_file
+    # only the process that owns the host lock may clean up the upload folder
+    remove_stale_upload_temp_files()
+
+    displayObject = Displayer(file_list=[], duration_of_files_seconds=10, on=False, brightness=20)
+    display_thread = threading.Thread(target=displayObject.run, daemon=True)
+    display_thread.start()
+    return displayObject
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -78,12 +165,21 @@ def uploadFile():
         # Upload file flask
         files = request.files.getlist('uploaded-file')
         # Extracting uploaded data file name
-        for file in files:
-            if file and allowed_file(file.filename):
-                filename = secure_filename(file.filename)
-                path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                file.save(path)
-                new_file_path = process_file(path, 1)
+        # the atlas is not updated while files are processed, end_ingest() syncs it once they are done
+        library_atlas.begin_ingest()
+        try:
+            for file in files:
+                # the upload has already been streamed to a temporary file by UploadRequest,
+                # temporary files that are not moved into place here are removed by remove_upload_temp_files()
+                temp_path = file.stream.name
+                file.stream.close()
+                if file and allowed_file(file.filename):
+                    filename = secure_filename(file.filename)
+                    path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
+                    os.replace(temp_path, path)
+                    new_file_path = process_file(path, 1)
+        finally:
+            library_atlas.end_ingest()
                 
         # img_file_path = session.get('uploaded_img_file_path', None)
         # Display image in Flask application web page
@@ -115,7 +211,8 @@ def play():
 @app.route('/load',  methods=("POST", "GET"))
 def load():
     path = "static/uploads"
-    dir_list = os.listdir(path)
+    # skip hidden files such as in-progress uploads
+    dir_list = [name for name in os.listdir(path) if not name.startswith('.')]
     
     return jsonify(result= dir_list)
 
@@ -127,11 +224,33 @@ def delete():
     for x in result: 
         print(x)
         os.remove("static/uploads/"+x)
+    library_atlas.sync()
 
     print(data)
     return jsonify(result= result)
 
+@app.route('/library',  methods=("GET",))
+def library():
+    '''Returns the URL of the thumbnail sprite sheet and the offset of every uploaded file in it.
+
+    The response carries an ETag that only changes when the library changes, and the sheet URL is versioned with
+    the same tag, so an unchanged library page costs one 304 and a cached image.
+    '''
+    library_atlas.sync()
+    offsets, etag = library_atlas.get_map()
+    offsets['atlas'] = f"static/atlas/library.png?v={etag}"
+
+    response = jsonify(result=offsets)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
+
   
   
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    # development server only, use serve.py in production
+    # with debug=True this module is imported by both the reloader and the server process,
+    # only the server process starts the display
+    if is_running_from_reloader():
+        start_display()
+    app.run(debug=True)
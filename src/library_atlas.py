@@ -0,0 +1,215 @@
+from PIL import Image
+from PIL.PngImagePlugin import PngInfo
+import numpy as np
+import cv2
+import hashlib
+import json
+import os
+import threading
+from file_processor import get_file_extension
+
+class LibraryAtlas:
+    '''Keeps a single sprite sheet with the first frame of every file in the upload folder.
+
+    The sheet is a grid of CELL_SIZE x CELL_SIZE cells, COLUMNS cells wide. Each file owns one cell,
+    cells freed by deleted files are reused by the next added file so only changed cells are redrawn.
+    The sheet and its offset map are cached on disk so restarts do not need to re-read every file.
+    '''
+    CELL_SIZE = 32
+    COLUMNS = 32
+
+    def __init__(self, upload_folder, atlas_folder):
+        '''
+            parameters:
+                upload_folder (str): The folder containing the uploaded '.png', '.gif', and '.mp4' files
+
+                atlas_folder (str): The folder the sprite sheet ('library.png') and offset map ('library.json') are written to
+        '''
+        self.upload_folder = upload_folder
+        self.atlas_folder = atlas_folder
+        self.image_path = os.path.join(atlas_folder, 'library.png')
+        self.map_path = os.path.join(atlas_folder, 'library.json')
+
+        # slots[i] is the name of the file drawn in cell i, or None if the cell is free
+        self.slots = []
+        # name -> mtime of the file when its cell was drawn, used to detect files replaced under the same name
+        self.mtimes = {}
+        self.sheet = np.zeros((0, self.COLUMNS * self.CELL_SIZE, 3), dtype=np.uint8)
+        self.etag = None
+        # number of uploads currently being processed, see begin_ingest()
+        self.ingesting = 0
+        self.lock = threading.Lock()
+
+        os.makedirs(atlas_folder, exist_ok=True)
+        self._load()
+
+    def sync(self):
+        '''Brings the sprite sheet up to date with the upload folder.
+
+        Only files that were added, removed, or replaced since the last call are read, the sheet is only
+        rewritten to disk when something changed.
+
+        While an upload is being processed the upload folder holds half-written intermediate files, so the
+        scan is skipped and the current sheet is kept until end_ingest() syncs.
+
+        returns: (bool) whether the sheet changed
+        '''
+        with self.lock:
+            if self.ingesting:
+                return False
+
+            current = {}
+            for name in os.listdir(self.upload_folder):
+                path = os.path.join(self.upload_folder, name)
+                if name.startswith('.') or get_file_extension(name) not in ['.png', '.gif', '.mp4']:
+                    continue
+                # uploads and deletes run on other server threads, so the file can disappear while it is being looked at
+                try:
+                    if os.path.isfile(path):
+                        current[name] = os.path.getmtime(path)
+                except OSError:
+                    continue
+
+            changed = False
+            for idx, name in enumerate(self.slots):
+                if name is not None and (name not in current or current[name] != self.mtimes[name]):
+                    self.slots[idx] = None
+                    del self.mtimes[name]
+                    self._draw_cell(idx, None)
+                    changed = True
+
+            for name in sorted(current):
+                if name in self.mtimes:
+                    continue
+                idx = self._free_slot()
+                self.slots[idx] = name
+                self.mtimes[name] = current[name]
+                self._draw_cell(idx, self._first_frame(os.path.join(self.upload_folder, name)))
+                changed = True
+
+            if changed or self.etag is None:
+                self._trim()
+                self._save()
+            return changed
+
+    def begin_ingest(self):
+        '''Marks the start of processing uploaded files, sync() does nothing until the matching end_ingest()'''
+        with self.lock:
+            self.ingesting += 1
+
+    def end_ingest(self):
+        '''Marks the end of processing uploaded files and syncs once no other upload is being processed'''
+        with self.lock:
+            self.ingesting -= 1
+        self.sync()
+
+    def get_map(self):
+        '''Returns the offset map for the sprite sheet and its ETag.
+
+        returns: (dict, str) where the dict has the form
+            {'cell': 32, 'width': w, 'height': h, 'items': {name: [x, y], ...}}
+        '''
+        with self.lock:
+            return self._map(), self.etag
+
+    def _map(self):
+        items = {}
+        for idx, name in enumerate(self.slots):
+            if name is not None:
+                items[name] = [(idx % self.COLUMNS) * self.CELL_SIZE, (idx // self.COLUMNS) * self.CELL_SIZE]
+        return {'cell': self.CELL_SIZE, 'width': self.sheet.shape[1], 'height': self.sheet.shape[0], 'items': items}
+
+    def _free_slot(self):
+        '''MUST HOLD self.lock. Returns the index of a free cell, growing the sheet by a row if there is none'''
+        for idx, name in enumerate(self.slots):
+            if name is None:
+                return idx
+
+        self.slots.append(None)
+        rows_needed = (len(self.slots) + self.COLUMNS - 1) // self.COLUMNS
+        if rows_needed * self.CELL_SIZE > self.sheet.shape[0]:
+            row = np.zeros((self.CELL_SIZE, self.sheet.shape[1], 3), dtype=np.uint8)
+            self.sheet = np.concatenate((self.sheet, row))
+        return len(self.slots) - 1
+
+    def _trim(self):
+        '''MUST HOLD self.lock. Drops free cells at the end of the sheet and any rows left empty'''
+        while self.slots and self.slots[-1] is None:
+            self.slots.pop()
+        rows_needed = (len(self.slots) + self.COLUMNS - 1) // self.COLUMNS
+        self.sheet = self.sheet[:rows_needed * self.CELL_SIZE]
+
+    def _draw_cell(self, idx, frame):
+        '''MUST HOLD self.lock. Draws frame (CELL_SIZE x CELL_SIZE x 3 array) into cell idx, or clears it if frame is None'''
+        y, x = (idx // self.COLUMNS) * self.CELL_SIZE, (idx % self.COLUMNS) * self.CELL_SIZE
+        self.sheet[y:y + self.CELL_SIZE, x:x + self.CELL_SIZE] = 0 if frame is None else frame
+
+    def _first_frame(self, path):
+        '''Returns the first frame of the file at path as a CELL_SIZE x CELL_SIZE x 3 RGB array, or None if it cannot be read'''
+        try:
+            if get_file_extension(path) == '.mp4':
+                mp4_capture = cv2.VideoCapture(path)
+                success, frame = mp4_capture.read()
+                mp4_capture.release()
+                if not success:
+                    return None
+                img = Image.fromarray(frame[..., ::-1])
+            else:
+                with Image.open(path) as file:
+                    file.seek(0)
+                    img = file.convert('RGB')
+            return np.asarray(img.resize((self.CELL_SIZE, self.CELL_SIZE)))
+        except Exception as e:
+            print(f'Could not read first frame of "{path}": {e}')
+            return None
+
+    def _load(self):
+        '''Loads the cached sheet and offset map from atlas_folder if both exist and match'''
+        if not (os.path.exists(self.image_path) and os.path.exists(self.map_path)):
+            return
+        try:
+            with open(self.map_path) as f:
+                cached = json.load(f)
+            with Image.open(self.image_path) as img:
+                sheet_etag = img.info.get('etag')
+                sheet = np.array(img.convert('RGB'))
+            slots, mtimes, etag = cached['slots'], cached['mtimes'], cached['etag']
+            cell = cached['cell']
+        except Exception as e:
+            print(f'Ignoring unreadable library atlas cache: {e}')
+            return
+
+        # the sheet and the map are replaced one after the other, a crash in between leaves a sheet from a different save
+        if sheet_etag != etag:
+            print('Ignoring library atlas cache: sheet and offset map are from different saves')
+            return
+
+        # an empty library is saved as a 1 pixel high placeholder image, so crop to the rows actually in use
+        rows_needed = (len(slots) + self.COLUMNS - 1) // self.COLUMNS
+        if cell != self.CELL_SIZE or sheet.shape[1] != self.COLUMNS * self.CELL_SIZE or sheet.shape[0] < rows_needed * self.CELL_SIZE:
+            return
+
+        self.slots = slots
+        self.mtimes = mtimes
+        self.sheet = sheet[:rows_needed * self.CELL_SIZE]
+        self.etag = etag
+
+    def _save(self):
+        '''MUST HOLD self.lock. Writes the sheet and offset map to atlas_folder and updates the ETag'''
+        state = {'cell': self.CELL_SIZE, 'slots': self.slots, 'mtimes': self.mtimes}
+        self.etag = hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+        state['etag'] = self.etag
+
+        # write to temporary files first so a reader never sees a half written sheet
+        # the ETag is also stored in the sheet so _load() can tell whether the sheet and the map belong together
+        image_tmp, map_tmp = self.image_path + '.tmp', self.map_path + '.tmp'
+        png_info = PngInfo()
+        png_info.add_text('etag', self.etag)
+        if self.sheet.shape[0]:
+            Image.fromarray(self.sheet).save(image_tmp, format='PNG', pnginfo=png_info)
+        else:
+            Image.new('RGB', (self.sheet.shape[1], 1)).save(image_tmp, format='PNG', pnginfo=png_info)
+        with open(map_tmp, 'w') as f:
+            json.dump(state, f)
+        os.replace(image_tmp, self.image_path)
+        os.replace(map_tmp, self.map_path)
@@ -0,0 +1,14 @@
+from waitress import serve
+import os
+from app import app, start_display
+
+# production entry point, started by LightFrame.service
+# waitress is a multi-threaded WSGI server, unlike the flask dev server it spools large request bodies
+# to disk and serves many clients at once while the display engine keeps running in its own thread
+HOST = os.environ.get('LIGHTFRAME_HOST', '0.0.0.0')
+PORT = int(os.environ.get('LIGHTFRAME_PORT', 5000))
+THREADS = int(os.environ.get('LIGHTFRAME_THREADS', 4))
+
+if __name__ == '__main__':
+    start_display()
+    serve(app, host=HOST, port=PORT, threads=THREADS)